@@ -37,13 +37,30 @@
 # Import dependencies
 ########################################################################
 
-from os import listdir
+from os import scandir, unlink, replace
+from shutil import which
 import subprocess
 from time import time, strptime, mktime
 from datetime import datetime
+from functools import lru_cache
+import re
 import argparse
 import logging
 
+# NumPy is optional, the cleaning evaluator falls back on pure Python
+# loops when it is not installed.
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# Numba is optional as well, when installed the log evaluator kernel is
+# compiled to native code, otherwise the NumPy path is the fastest one.
+try:
+    import numba
+except ImportError:
+    numba = None
+
 
 
 
@@ -124,7 +141,7 @@ SCRIPT_PARAMETERS = {
 # Get script passed parameters
 ########################################################################
 
-def get_script_parameters() -> argparse.Namespace:
+def build_script_parameters_parser() -> argparse.ArgumentParser:
     # I use argparse to manage script parameters, SCRIPT_PARAMETERS defines each
     parser = argparse.ArgumentParser()
     for key, value in SCRIPT_PARAMETERS.items():
@@ -136,8 +153,13 @@ def get_script_parameters() -> argparse.Namespace:
             help=value['help'],
             default=value['default']
         )
-    args = parser.parse_args()
-    return args
+    return parser
+
+# Built once at import, repeated calls to get_script_parameters reuse it.
+SCRIPT_PARAMETERS_PARSER = build_script_parameters_parser()
+
+def get_script_parameters() -> argparse.Namespace:
+    return SCRIPT_PARAMETERS_PARSER.parse_args()
 
 
 
@@ -155,19 +177,22 @@ def get_script_parameters() -> argparse.Namespace:
 class SubprocessFailedError(Exception):
     pass
 
-def run_subprocess(cmd: str) -> str:
-    cmd_args = cmd.split(" ")
-    with subprocess.Popen(cmd_args, stdout=subprocess.PIPE, stderr=subprocess.PIPE) as pipe:
+def run_subprocess(cmd_args: [str], capture: bool = False) -> (int, str):
+    # cmd_args is an argv list, so paths containing spaces stay intact.
+    # Unless the caller asks to capture it, stdout goes to DEVNULL and
+    # nothing is buffered nor decoded in Python.
+    stdout = subprocess.PIPE if capture else subprocess.DEVNULL
+    with subprocess.Popen(cmd_args, stdout=stdout, stderr=subprocess.PIPE) as pipe:
         std_out, std_err = pipe.communicate()
-        std_out_msg = std_out.decode("utf-8")[:-1] # Removed the last \n char.
-        std_err_msg = std_err.decode("utf-8")[:-1]
         return_code = pipe.returncode
         if (return_code == 0):
-            # The command has run as expected.
-            return return_code, std_out_msg, std_err_msg
+            # The command has run as expected, only captured output
+            # pays the decode cost.
+            std_out_msg = std_out.decode("utf-8")[:-1] if capture else "" # Removed the last \n char.
+            return return_code, std_out_msg
         else:
-            # The command has failed.
-            raise SubprocessFailedError(return_code, std_out_msg, std_err_msg)
+            # The command has failed, stderr is decoded for the report.
+            raise SubprocessFailedError(return_code, std_err.decode("utf-8")[:-1])
 
 
 
@@ -182,6 +207,23 @@ def run_subprocess(cmd: str) -> str:
 # Backup files manipulation
 ########################################################################
 
+@lru_cache(maxsize=4096)
+def parse_timestamp(str_date: str) -> float:
+    # Returns the timestamp matching str_date, raises ValueError otherwise.
+    # Cached as every backup filename is parsed several times per run.
+    # TIMESTAMP_FORMAT is fixed width, so slicing and int() replace the
+    # much slower general purpose strptime parser.
+    if (len(str_date) != 19
+            or str_date[4] != "-" or str_date[7] != "-" or str_date[10] != "_"
+            or str_date[13] != "-" or str_date[16] != "-"):
+        # Unexpected shape, let strptime handle it or raise ValueError.
+        return mktime(strptime(str_date, TIMESTAMP_FORMAT))
+    # The datetime constructor validates the field ranges and raises
+    # ValueError itself, and timestamp() interprets the naive date in
+    # local time exactly like the previous strptime+mktime detour.
+    return datetime(int(str_date[0:4]), int(str_date[5:7]), int(str_date[8:10]),
+        int(str_date[11:13]), int(str_date[14:16]), int(str_date[17:19])).timestamp()
+
 class BackupFilesManipulator:
 
     def __init__(self, src_dir: str, bkp_dir: str, bkp_prefix: str, compress: bool) -> None:
@@ -194,37 +236,59 @@ class BackupFilesManipulator:
             self.bkp_suffix = "tar.gz"
         else:
             self.bkp_suffix = "tar"
-        # Compute date char indexes for filenames checking.
-        self.filename_date_start_index = len(self.bkp_prefix) + 1
-        self.filename_date_stop_index = -1 * (len(self.bkp_suffix) + 1)
+        # pigz produces gzip compatible output using every core,
+        # tar falls back on its single threaded -z when it is not installed.
+        self.compressor = which("pigz") if self.compress else None
+        # Cached directory listing, invalidated whenever a backup is
+        # created or removed.
+        self.bkp_filenames_cache = None
+        # Compile the expected filename shape once,
+        # it rejects non backup filenames without paying a strptime call.
+        self.bkp_filename_pattern = re.compile(
+            re.escape(self.bkp_prefix)
+            + r"_(\d{4}-\d{2}-\d{2}_\d{2}-\d{2}-\d{2})\."
+            + re.escape(self.bkp_suffix) + r"$")
 
     def is_bkp_file(self, filename: str) -> bool:
         # Returns True if the filename is like bkp_prefix_YY-mm-dd_HH-MM-SS.bkp_suffix
-        if filename.startswith(self.bkp_prefix) and filename.endswith(self.bkp_suffix):
-            str_date = filename[self.filename_date_start_index : self.filename_date_stop_index]
-            try:
-                strptime(str_date, TIMESTAMP_FORMAT)
-                return True
-            except:
-                return False
-        else:
+        # The regex validates the shape, parse_timestamp the calendar
+        # ranges, so a foreign file with an impossible date is skipped
+        # here instead of blowing up the later timestamp pass. The
+        # parse_timestamp cache makes that later pass free anyway.
+        match = self.bkp_filename_pattern.match(filename)
+        if match is None:
+            return False
+        try:
+            parse_timestamp(match.group(1))
+            return True
+        except ValueError:
             return False
 
+    def invalidate_bkp_filenames_cache(self) -> None:
+        self.bkp_filenames_cache = None
+
     def get_bkp_filenames(self) -> [str]:
         # Returns a list of filenames from the bkp_dir whose names correspond to backups
+        # A copy of the cache is returned so callers can mutate it freely.
+        if self.bkp_filenames_cache is not None:
+            return list(self.bkp_filenames_cache)
         try:
-            filenames = listdir(self.bkp_dir)
-            bkp_filenames = [filename for filename in filenames if self.is_bkp_file(filename)]
-            return bkp_filenames
+            # scandir gives the file type from the dirent data,
+            # so subdirectories are skipped without an extra stat call.
+            with scandir(self.bkp_dir) as entries:
+                bkp_filenames = [entry.name for entry in entries
+                    if entry.is_file(follow_symlinks=False) and self.is_bkp_file(entry.name)]
+            self.bkp_filenames_cache = bkp_filenames
+            return list(bkp_filenames)
         except FileNotFoundError as err:
             logging.error(f"Failed to list backup filesnames in {self.bkp_dir}\n\t{err}")
 
     def get_file_timestamp_from_filename(self, filename: str) -> int:
         # Returns timestamp from bkp_prefix_YY-mm-dd_HH-MM-SS.bkp_suffix
-        str_date = filename[self.filename_date_start_index : self.filename_date_stop_index]
-        struct_time = strptime(str_date, TIMESTAMP_FORMAT)
-        timestamp = mktime(struct_time)
-        return timestamp
+        match = self.bkp_filename_pattern.match(filename)
+        # parse_timestamp is cached, so filenames already seen by is_bkp_file
+        # are not parsed a second time.
+        return parse_timestamp(match.group(1))
 
     def get_bkp_filename_from_timestamp(self, timestamp: int) -> str:
         # Returns bkp_prefix_YY-mm-dd_HH-MM-SS.bkp_suffix from timestamp.
@@ -237,34 +301,74 @@ class BackupFilesManipulator:
         return [self.get_file_timestamp_from_filename(filename) for filename in bkp_filenames]
 
     def get_number_of_bkp(self) -> int:
-        try:
-            return len(self.get_bkp_filenames())
-        except:
-            return 0
+        return len(self.get_bkp_filenames() or [])
 
     def archive(self) -> None:
         timestamp = time()
         bkp_filename = self.get_bkp_filename_from_timestamp(timestamp)
         bkp_target = f"{self.bkp_dir}/{bkp_filename}"
-        if self.compress:
-            command = f"tar -czf {bkp_target} -C {self.src_dir} ."
-        else:
-            command = f"tar -cf {bkp_target} -C {self.src_dir} ."
+        # tar writes into a .part file which never matches the backup
+        # filename pattern, the finished archive is then published with
+        # an atomic rename so an interrupted run cannot leave a
+        # truncated file under the final backup name.
+        tmp_target = f"{bkp_target}.part"
+        self.invalidate_bkp_filenames_cache()
         try:
-            run_subprocess(command)
+            if self.compressor is not None:
+                # The output file is opened before tar is launched, so a
+                # missing bkp_dir fails before any child process exists.
+                with open(tmp_target, "wb") as bkp_file:
+                    # tar streams the archive to its stdout while the
+                    # compressor reads it and writes the compressed file,
+                    # both in parallel.
+                    tar_pipe = subprocess.Popen(
+                        ["tar", "-cf", "-", "-C", self.src_dir, "."],
+                        stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+                    compressor_pipe = subprocess.Popen(
+                        [self.compressor, "-c"], stdin=tar_pipe.stdout,
+                        stdout=bkp_file, stderr=subprocess.PIPE)
+                    # Close our copy of the pipe so the compressor sees
+                    # tar's EOF.
+                    tar_pipe.stdout.close()
+                    # Drain tar's stderr while the compressor consumes its
+                    # stdout: a chatty tar would otherwise fill the stderr
+                    # pipe, block, and never deliver that EOF.
+                    tar_err = tar_pipe.stderr.read()
+                    compressor_err = compressor_pipe.communicate()[1]
+                tar_pipe.stderr.close()
+                tar_pipe.wait()
+                for return_code, std_err in ((tar_pipe.returncode, tar_err),
+                        (compressor_pipe.returncode, compressor_err)):
+                    if return_code != 0:
+                        raise SubprocessFailedError(return_code,
+                            std_err.decode("utf-8")[:-1])
+            else:
+                run_subprocess(["tar", "-czf" if self.compress else "-cf",
+                    tmp_target, "-C", self.src_dir, "."])
+            replace(tmp_target, bkp_target)
             logging.info(f"Backuped {self.src_dir} into {bkp_target}")
-        except SubprocessFailedError as err:
+        except (SubprocessFailedError, OSError) as err:
             logging.error(f"Failed to backup {self.src_dir} into {bkp_target}\n\t{err}")
+            try:
+                unlink(tmp_target)
+            except OSError:
+                pass
 
     def rm_bkp_file(self, bkp_filename: str) -> None:
         bkp_target = f"{self.bkp_dir}/{bkp_filename}"
-        command = f"rm {bkp_target}"
+        self.invalidate_bkp_filenames_cache()
         try:
-            run_subprocess(command)
+            unlink(bkp_target)
             logging.info(f"Removed backup {bkp_target}")
-        except SubprocessFailedError as err:
+        except OSError as err:
             logging.error(f"Failed to remove backup {bkp_target}\n\t{err}")
 
+    def rm_bkp_files(self, bkp_filenames: [str]) -> None:
+        # Removes a whole batch of backups in one call, unlink has no per
+        # file process cost so a plain loop is enough.
+        for bkp_filename in bkp_filenames:
+            self.rm_bkp_file(bkp_filename)
+
 
 
 
@@ -278,6 +382,35 @@ class BackupFilesManipulator:
 # Backup cleaning evaluation
 ########################################################################
 
+if numba is not None:
+    @numba.njit(cache=True)
+    def log_bkp_index_kernel(bkp_timestamps, current_time: float,
+            expect_interval: float, decay_rate: float) -> int:
+        # Native version of the projected error computation below,
+        # one O(n) pass per diff with scalar accumulators.
+        n_backups = bkp_timestamps.shape[0]
+        ideal_times = numpy.empty(n_backups)
+        decay_power = 1.0
+        for n in range(n_backups):
+            ideal_times[n_backups - 1 - n] = current_time - expect_interval * (
+                n + decay_power - 1)
+            decay_power *= decay_rate
+        right_diff = numpy.empty(n_backups)
+        cumulated_error = 0.0
+        for n in range(n_backups - 1, -1, -1):
+            cumulated_error += abs(bkp_timestamps[n] - ideal_times[n])
+            right_diff[n] = cumulated_error
+        best_index = 1
+        best_error = numpy.inf
+        cumulated_error = 0.0
+        for n in range(1, n_backups - 1):
+            cumulated_error += abs(bkp_timestamps[n-1] - ideal_times[n])
+            projected_error = cumulated_error + right_diff[n+1]
+            if projected_error < best_error:
+                best_error = projected_error
+                best_index = n
+        return best_index
+
 class BackupCleaningEvaluator:
 
     def __init__(self, max_bkp_kept: int) -> None:
@@ -287,15 +420,15 @@ class BackupCleaningEvaluator:
         return number_of_bkp > self.max_bkp_kept
 
     def evaluator_older_bkp_index(self, bkp_timestamps: [float],
-            outdated_bkp_sec: int) -> int or None:
+            outdated_bkp_sec: int, current_time: float) -> int or None:
         # Returns the older_bkp if bkp_timestamps (sec) has been reached.
-        current_time = time()
-        bkp_timestamp = min(bkp_timestamps)
-        if current_time - bkp_timestamp > outdated_bkp_sec:
-            return bkp_timestamps.index(bkp_timestamp)
+        # bkp_timestamps is sorted ascending, so only the front entry
+        # can be outdated, no min()/index() scan is needed.
+        if current_time - bkp_timestamps[0] > outdated_bkp_sec:
+            return 0
 
-    def evaluator_log_bkp_index(self, bkp_timestamps: [float], expect_interval: int) -> int:
-        current_time = time()
+    def evaluator_log_bkp_index(self, bkp_timestamps: [float], expect_interval: int,
+            current_time: float) -> int:
         # The desired number of backups.
         backup_count = len(bkp_timestamps) - 1
         # The total date range between now and the oldest backup.
@@ -305,28 +438,56 @@ class BackupCleaningEvaluator:
         # A decay rate of 2.0 would dictate that each archived
         # backup would ideally be twice the age of its predecessor.
         decay_rate = (missing + 1) ** (1 / backup_count)
+        if numba is not None:
+            return int(log_bkp_index_kernel(
+                numpy.asarray(bkp_timestamps, dtype=numpy.float64),
+                current_time, expect_interval, decay_rate))
+        if numpy is not None:
+            # Vectorized version of the loops below, cumulative sums
+            # replace the quadratic list.insert(0, ...) pattern.
+            ts = numpy.asarray(bkp_timestamps, dtype=numpy.float64)
+            n_values = numpy.arange(len(ts) - 1, -1, -1)
+            ideal_times = current_time - expect_interval * (
+                n_values + decay_rate**n_values - 1)
+            abs_diff = numpy.abs(ts - ideal_times)
+            right_diff = numpy.cumsum(abs_diff[::-1])[::-1]
+            left_diff = numpy.concatenate(
+                ([0.0], numpy.cumsum(numpy.abs(ts[:-1] - ideal_times[1:]))))
+            projected_error = left_diff[:-1] + right_diff[1:]
+            return int(numpy.argmin(projected_error[1:]) + 1)
+        ts = bkp_timestamps
         # An array of time stamps that the backups should have.
+        # decay_rate powers come from a running multiply rather than one
+        # libm pow call per backup, so the list is built in ascending n
+        # order then reversed to keep the original ordering.
         ideal_times = []
-        for n in range(len(bkp_timestamps) - 1, -1, -1):
-            value = current_time - expect_interval * (n + (decay_rate**n) - 1)
+        decay_power = 1.0
+        for n in range(len(ts)):
+            value = current_time - expect_interval * (n + decay_power - 1)
             ideal_times.append(value)
+            decay_power *= decay_rate
+        ideal_times.reverse()
         # As we have bkp_timestamps and ideal_times,
         # we have to find the backup to delete to fit the ideal_times.
         # Then we compute cumulative errors from right then from left,
         # the least projected_error (right error + left error)
         # gives the backup to remove.
-        right_diff = [abs(bkp_timestamps[-1] - ideal_times[-1])]
-        for n in range(len(bkp_timestamps) - 2, -1, -1):
-            value = abs(bkp_timestamps[n] - ideal_times[n]) + right_diff[0]
-            right_diff.insert(0, value)
+        # Both diffs are running sums appended in O(1),
+        # right_diff is built backwards then reversed because
+        # insert(0, ...) would shift the whole list on every step.
+        right_diff = []
+        cumulated_error = 0
+        for n in range(len(ts) - 1, -1, -1):
+            cumulated_error += abs(ts[n] - ideal_times[n])
+            right_diff.append(cumulated_error)
+        right_diff.reverse()
         left_diff = [0]
-        for n in range(1, len(bkp_timestamps)):
-            value = abs(bkp_timestamps[n-1] - ideal_times[n]) + left_diff[-1]
-            left_diff.append(value)
-        projected_error = []
-        for n in range(len(bkp_timestamps) - 1):
-            value = left_diff[n] + right_diff[n+1]
-            projected_error.append(value)
+        cumulated_error = 0
+        for n in range(1, len(ts)):
+            cumulated_error += abs(ts[n-1] - ideal_times[n])
+            left_diff.append(cumulated_error)
+        projected_error = [left_diff[n] + right_diff[n+1]
+            for n in range(len(ts) - 1)]
         bkp_timestamp = min(projected_error[1:])
         bkp_timestamp_index = projected_error.index(bkp_timestamp)
         return bkp_timestamp_index
@@ -360,25 +521,64 @@ class BackupHandler:
         self.interval = interval
 
     def get_bkp_filenames_to_clean(self) -> [str]:
-        number_of_bkp = self.bkp_files_manipulator.get_number_of_bkp()
-        number_of_bkp_to_clean = max(number_of_bkp - self.max_bkp_kept, 0)
+        # List the backup directory once and reuse the result,
+        # get_number_of_bkp would scan and parse everything a second time.
+        bkp_filenames = self.bkp_files_manipulator.get_bkp_filenames() or []
+        number_of_bkp_to_clean = max(len(bkp_filenames) - self.max_bkp_kept, 0)
         if (number_of_bkp_to_clean == 0):
             return []
         else:
-            bkp_filenames = self.bkp_files_manipulator.get_bkp_filenames()
             bkp_timestamps = self.bkp_files_manipulator.get_bkp_timestamps_from_filenames(
                 bkp_filenames)
+            if numpy is not None:
+                # Structure-of-arrays layout: timestamps live in a
+                # float64 array and filenames in a parallel object array,
+                # sorted together through one argsort. The evaluators
+                # then work on unboxed floats directly.
+                bkp_timestamps = numpy.asarray(bkp_timestamps, dtype=numpy.float64)
+                bkp_filenames = numpy.asarray(bkp_filenames, dtype=object)
+                sort_indexes = numpy.argsort(bkp_timestamps)
+                bkp_timestamps = bkp_timestamps[sort_indexes]
+                bkp_filenames = bkp_filenames[sort_indexes]
+            else:
+                # Sort both lists by timestamp once, the evaluators rely
+                # on the ascending order to find the oldest backup in O(1).
+                sorted_pairs = sorted(zip(bkp_timestamps, bkp_filenames))
+                bkp_timestamps = [pair[0] for pair in sorted_pairs]
+                bkp_filenames = [pair[1] for pair in sorted_pairs]
             bkp_filenames_to_clean = []
+            # Evaluate every deletion against the same reference time,
+            # calling time() in the loop would drift between iterations.
+            current_time = time()
+            # Outdated backups are cleaned first: the collections are
+            # sorted ascending so they all sit at the front, drain them
+            # as one leading slice before the logarithmic evaluator.
+            # The cutoff is computed once and compared by index, O(1)
+            # per entry without copying anything.
+            outdated_cutoff = current_time - self.bkp_timestamps
+            outdated_count = 0
+            while (outdated_count < number_of_bkp_to_clean
+                    and bkp_timestamps[outdated_count] < outdated_cutoff):
+                outdated_count += 1
+            if (outdated_count > 0):
+                bkp_filenames_to_clean.extend(bkp_filenames[:outdated_count])
+                bkp_filenames = bkp_filenames[outdated_count:]
+                bkp_timestamps = bkp_timestamps[outdated_count:]
+                number_of_bkp_to_clean -= outdated_count
             for i in range(number_of_bkp_to_clean):
-                # If there are outdated backups, clean the oldest one,
-                # else clean via the logarithmic evaluator.
-                index_to_delete = self.bkp_cleaning_evaluator.evaluator_older_bkp_index(
-                    bkp_timestamps, self.bkp_timestamps)
-                if index_to_delete is None:
-                    index_to_delete = self.bkp_cleaning_evaluator.evaluator_log_bkp_index(
-                        bkp_timestamps, self.interval)
-                bkp_filenames_to_clean.append(bkp_filenames.pop(index_to_delete))
-                bkp_timestamps.pop(index_to_delete)
+                index_to_delete = self.bkp_cleaning_evaluator.evaluator_log_bkp_index(
+                    bkp_timestamps, self.interval, current_time)
+                bkp_filenames_to_clean.append(bkp_filenames[index_to_delete])
+                if numpy is not None:
+                    # Indexed deletion on arrays goes through a boolean
+                    # mask, lists simply pop.
+                    keep_mask = numpy.ones(len(bkp_timestamps), dtype=bool)
+                    keep_mask[index_to_delete] = False
+                    bkp_timestamps = bkp_timestamps[keep_mask]
+                    bkp_filenames = bkp_filenames[keep_mask]
+                else:
+                    bkp_timestamps.pop(index_to_delete)
+                    bkp_filenames.pop(index_to_delete)
             return bkp_filenames_to_clean
 
     def archive(self) -> None:
@@ -386,8 +586,7 @@ class BackupHandler:
 
     def clean_bkp_dir(self) -> None:
         bkp_filenames_to_clean = self.get_bkp_filenames_to_clean()
-        for filename in bkp_filenames_to_clean:
-            self.bkp_files_manipulator.rm_bkp_file(filename)
+        self.bkp_files_manipulator.rm_bkp_files(bkp_filenames_to_clean)
 
 
 